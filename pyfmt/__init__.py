@@ -1,10 +1,34 @@
+import contextlib
+import io
+import itertools
+import os
+import re
 import shlex
 import subprocess
 import sys
-from subprocess import PIPE
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from subprocess import PIPE, STDOUT
+
+from pyfmt import _cache
+
+try:
+    import black
+    import isort
+    import toml
+except ImportError:  # Only the isort and black command line tools are available.
+    black = isort = toml = None
 
 TARGET_VERSION = f"py{sys.version_info.major}{sys.version_info.minor}"
 
+# Directories never worth descending into when looking for code to format. Hidden directories
+# (.git, .venv, .tox, ...) are skipped as well.
+SKIP_DIRS = frozenset(["venv", "node_modules", "__pycache__", "build", "dist"])
+
+# Room for the paths on a formatter's command line. Windows allows only 32k characters in all.
+MAX_PATHS_LENGTH = 30000 if sys.platform == "win32" else 200000
+
 ISORT_CMD = [
     "isort",
     "--force-grid-wrap=0",
@@ -14,44 +38,397 @@ ISORT_CMD = [
     "--recursive",
     "--trailing-comma",
     "{extra_isort_args}",
-    "{path}",
+    "{paths}",
 ]
 BLACK_CMD = [
     "black",
     "--line-length={line_length}",
     f"--target-version={TARGET_VERSION}",
     "{extra_black_args}",
-    "{path}",
+    "{paths}",
 ]
 
+# ISORT_CMD's options as SortImports settings, for when isort runs in this process.
+ISORT_SETTINGS = {
+    "force_grid_wrap": 0,
+    "multi_line_output": 3,
+    "use_parentheses": True,
+    "include_trailing_comma": True,
+}
+
+# [tool.black] options that can be applied when black runs in this process. The line length and
+# target version always come from pyfmt, as BLACK_CMD passes them explicitly too.
+BLACK_CONFIG_KEYS = frozenset(
+    [
+        "line_length",
+        "target_version",
+        "skip_string_normalization",
+        "include",
+        "exclude",
+        "fast",
+        "quiet",
+        "verbose",
+    ]
+)
+
 
 def pyfmt(path, check=False, line_length=100, extra_isort_args="", extra_black_args="") -> int:
     """Run isort and black with the given params and print the results."""
+    if can_format_in_process(extra_isort_args, extra_black_args):
+        black_config = read_black_config(path)
+        if black_config is not None:
+            return format_in_process(path, black_config, check=check, line_length=line_length)
+
     if check:
         extra_isort_args += " --check-only"
         extra_black_args += " --check"
 
-    isort_exitcode = run_formatter(
-        ISORT_CMD, path, line_length=line_length, extra_isort_args=extra_isort_args
+    # isort gets the files themselves, so it doesn't have to walk the tree again. Biggest first, so
+    # the slow ones start early and get spread across a process per CPU, as isort handles one file
+    # at a time. black already spreads files over all CPUs by itself, and is given the path as is:
+    # its --exclude and [tool.black] settings only apply to the directories it walks.
+    walk_errors = []
+    files = [
+        file_path for _, file_path in sorted(find_python_files(path, walk_errors), reverse=True)
+    ]
+    files = files or [path]
+    isort_cmds = [
+        build_cmd(ISORT_CMD, paths, line_length=line_length, extra_isort_args=extra_isort_args)
+        for paths in split_paths(files, os.cpu_count() or 1)
+    ]
+    black_cmd = build_cmd(
+        BLACK_CMD, [path], line_length=line_length, extra_black_args=extra_black_args
     )
-    black_exitcode = run_formatter(
-        BLACK_CMD, path, line_length=line_length, extra_black_args=extra_black_args
+
+    if check:
+        # Nothing gets written in check mode, so both formatters can look at the code at once.
+        isort_procs = [start_formatter(cmd) for cmd in isort_cmds]
+        black_proc = start_formatter(black_cmd)
+        isort_exitcode = print_result(isort_cmds[0], isort_procs, walk_errors)
+        black_exitcode = print_result(black_cmd, [black_proc])
+    else:
+        # Otherwise black has to format isort's output, so they run one after the other.
+        isort_procs = [start_formatter(cmd) for cmd in isort_cmds]
+        isort_exitcode = print_result(isort_cmds[0], isort_procs, walk_errors)
+        black_exitcode = print_result(black_cmd, [start_formatter(black_cmd)])
+
+    return isort_exitcode or black_exitcode
+
+
+def can_format_in_process(extra_isort_args="", extra_black_args="") -> bool:
+    """Whether isort and black can be used as libraries instead of starting them as commands."""
+    # Extra args are command line options, so only the commands know what to do with them.
+    return (
+        black is not None
+        and not extra_isort_args.strip()
+        and not extra_black_args.strip()
+        and TARGET_VERSION.upper() in black.TargetVersion.__members__
     )
 
+
+def read_black_config(path):
+    """Read the [tool.black] options the black command would use for path.
+
+    Returns None if they can't be read or include options only the black command can apply.
+    """
+    pyproject = black.find_project_root((os.path.abspath(path),)) / "pyproject.toml"
+    if not pyproject.is_file():
+        return {}
+
+    try:
+        config = toml.load(str(pyproject)).get("tool", {}).get("black", {})
+        config = {key.replace("--", "").replace("-", "_"): value for key, value in config.items()}
+        for key in ["include", "exclude"]:
+            if key in config:
+                black.re_compile_maybe_verbose(config[key])
+    except (toml.TomlDecodeError, OSError, re.error):
+        return None
+
+    return config if set(config) <= BLACK_CONFIG_KEYS else None
+
+
+def find_black_files(path, black_config) -> set:
+    """Find the files the black command would format if given path, by its include and exclude.
+
+    black walks every directory its exclude doesn't match, including the ones pyfmt skips.
+    """
+    if not os.path.isdir(path):
+        return {os.path.normpath(path)}
+
+    include = black.re_compile_maybe_verbose(black_config.get("include", black.DEFAULT_INCLUDES))
+    exclude = black.re_compile_maybe_verbose(black_config.get("exclude", black.DEFAULT_EXCLUDES))
+    root = black.find_project_root((os.path.abspath(path),))
+    return {
+        os.path.normpath(str(file_path))
+        for file_path in black.gen_python_files_in_dir(
+            Path(path), root, include, exclude, black.Report()
+        )
+    }
+
+
+def format_in_process(path, black_config, check=False, line_length=100) -> int:
+    """Run isort and black as libraries on every Python file under path and print the results."""
+    walk_errors, black_errors = [], []
+    isort_files = {
+        os.path.normpath(file_path): size
+        for size, file_path in find_python_files(path, walk_errors)
+    }
+    try:
+        black_files = find_black_files(path, black_config)
+    except OSError as exc:  # The black command gives up on the whole path too.
+        black_files, black_errors = set(), [f"error: cannot format {path}: {exc}"]
+    # Biggest first, so no large file is left running on its own at the end. Only the few files
+    # just black looks at still need their size.
+    sizes = dict(isort_files)
+    for file_path in black_files - isort_files.keys():
+        sizes[file_path] = os.path.getsize(file_path)
+    files = sorted(sizes, key=sizes.get, reverse=True)
+    # Files which haven't changed since they were last formatted with these settings are skipped.
+    # Not with check though: CI relies on that, so it always looks at every file.
+    if not check:
+        versions = f"{isort.__version__} {black.__version__} {_cache.config_digest(path)}"
+        # isort sorts imports into sections by what is installed, so the environment counts too.
+        environment = f"{sys.executable} {os.getenv('VIRTUAL_ENV', '')}"
+        cache_key = f"{TARGET_VERSION} {line_length} {versions} {environment}"
+        cache = _cache.load_cache(cache_key)
+        files = _cache.filter_unchanged(files, cache)
+
+    use_isort = [file_path in isort_files for file_path in files]
+    use_black = [file_path in black_files for file_path in files]
+    format_one = partial(
+        format_file,
+        check=check,
+        line_length=line_length,
+        string_normalization=not black_config.get("skip_string_normalization", False),
+    )
+    if (os.cpu_count() or 1) > 1 and len(files) > 1:
+        with ProcessPoolExecutor() as executor:
+            results = list(executor.map(format_one, files, use_isort, use_black))
+    else:
+        results = [format_one(*args) for args in zip(files, use_isort, use_black)]
+
+    isort_lines, isort_exitcodes, black_lines, black_exitcodes = list(zip(*results)) or [()] * 4
+    # All the output is known by now, so print it in one go rather than line by line.
+    isort_lines = [f"ERROR: {error}" for error in walk_errors] + list(itertools.chain(*isort_lines))
+    black_lines = black_errors + list(itertools.chain(*black_lines))
+    isort_output = format_output("isort", isort_lines)
+    black_output = format_output("black", black_lines)
+    print(f"{isort_output}\n{black_output}")
+
+    if not check:
+        # Only files that both isort and black ran on and were happy with (exit code 0) are known
+        # to be formatted.
+        formatted = [
+            file_path
+            for file_path, result in zip(files, results)
+            if file_path in black_files and not any(result[1::2])
+        ]
+        _cache.record(formatted, cache)
+        _cache.save_cache(cache_key, cache)
+
+    isort_exitcode = max(isort_exitcodes, default=0) or int(bool(walk_errors))
+    black_exitcode = max(black_exitcodes, default=0) or (123 if black_errors else 0)
     return isort_exitcode or black_exitcode
 
 
-def run_formatter(cmd, path, **kwargs) -> int:
-    """Helper to run a shell command and print prettified output."""
-    cmd = shlex.split(" ".join(cmd).format(path=path, **kwargs))
-    result = subprocess.run(cmd, stdout=PIPE, stderr=PIPE)
+def format_file(
+    file_path,
+    use_isort=True,
+    use_black=True,
+    check=False,
+    line_length=100,
+    string_normalization=True,
+) -> tuple:
+    """Run isort then black on one file, returning the output lines and exit code of each.
+
+    The file is read once and black formats isort's result directly, so it is written at most
+    once. With check, each formatter looks at the file as it is, like their command line checks.
+    Either is left out when use_isort or use_black is false, i.e. when it wouldn't find the file.
+    """
+    try:
+        with open(file_path, "rb") as handle:
+            src, encoding, newline = black.decode_bytes(handle.read())
+    except Exception as exc:
+        return [], 0, [f"error: cannot format {file_path}: {exc}"], 123
 
-    prefix = f"{cmd[0]}: "
-    sep = "\n" + (" " * len(prefix))
-    lines = result.stdout.decode().splitlines() + result.stderr.decode().splitlines()
-    if "".join(lines) == "":
+    sorted_src, isort_lines, isort_exitcode = src, [], 0
+    if use_isort:
+        output = io.StringIO()
+        try:
+            # check=True stops SortImports writing the file itself, and has it compare the result
+            # the way the isort command's check does. Given the absolute path, its messages match.
+            with contextlib.redirect_stdout(output):
+                result = isort.SortImports(
+                    os.path.abspath(file_path),
+                    file_contents=src,
+                    check=True,
+                    line_length=line_length,
+                    **ISORT_SETTINGS,
+                )
+        except Exception as exc:
+            return [f"ERROR: {file_path} {exc}"], 1, [], 0
+
+        if not result.skipped:
+            sorted_src = result.output
+            if check:
+                isort_lines = output.getvalue().splitlines()
+                isort_exitcode = int(result.incorrectly_sorted)
+            elif sorted_src != src:
+                isort_lines = [f"Fixing {os.path.abspath(file_path)}"]
+
+    mode = black.FileMode(
+        target_versions={black.TargetVersion[TARGET_VERSION.upper()]},
+        line_length=line_length,
+        string_normalization=string_normalization,
+        is_pyi=file_path.endswith(".pyi"),
+    )
+    black_src = src if check else sorted_src
+    dst, black_lines, black_exitcode = black_src, [], 0
+    try:
+        if use_black:
+            dst = black.format_file_contents(black_src, fast=False, mode=mode)
+            black_lines = [f"{'would reformat' if check else 'reformatted'} {file_path}"]
+            black_exitcode = int(check)
+    except black.NothingChanged:
+        pass
+    except Exception as exc:
+        black_lines, black_exitcode = [f"error: cannot format {file_path}: {exc}"], 123
+
+    if not check and dst != src:
+        try:
+            with open(file_path, "w", encoding=encoding, newline=newline) as handle:
+                handle.write(dst)
+        except OSError as exc:
+            black_lines, black_exitcode = [f"error: cannot format {file_path}: {exc}"], 123
+
+    return isort_lines, isort_exitcode, black_lines, black_exitcode
+
+
+def find_python_files(path, errors) -> list:
+    """Find all Python source and stub files at or under the given path as (size, path) pairs.
+
+    Directories which can't be read are left out, and the OSError for each is added to errors.
+    """
+    if not os.path.isdir(path):
+        return [(0, path)]
+
+    if hasattr(os, "fwalk"):
+        # fwalk's errors only name a directory relative to its parent, so when there are any, the
+        # tree is walked again with scandir, whose errors give the whole path.
+        fwalk_errors = []
+        files = _fwalk(path, fwalk_errors)
+        if not fwalk_errors:
+            return files
+
+    files = []
+    _scan(path, files, errors)
+    return files
+
+
+def _fwalk(path, errors) -> list:
+    """Collect (size, path) pairs for the Python files under path, stat'ing relative to each dir."""
+    files = []
+    # The trailing separator makes fwalk follow path itself when it's a symlink to a directory.
+    walk = os.fwalk(os.path.join(path, ""), onerror=errors.append)
+    for dirpath, dirnames, filenames, dir_fd in walk:
+        dirnames[:] = [
+            name for name in dirnames if not name.startswith(".") and name not in SKIP_DIRS
+        ]
+        # Joined once per directory; each file's path is then a plain concatenation.
+        prefix = dirpath if dirpath.endswith(os.sep) else dirpath + os.sep
+        for name in filenames:
+            if name.endswith((".py", ".pyi")):
+                try:
+                    size = os.stat(name, dir_fd=dir_fd).st_size
+                except FileNotFoundError:  # A broken symlink.
+                    continue
+                files.append((size, prefix + name))
+    return files
+
+
+def _scan(dirpath, files, errors):
+    """Recursively collect (size, path) pairs for the Python files under dirpath, without fwalk."""
+    try:
+        entries = os.scandir(dirpath)
+    except OSError as exc:
+        errors.append(exc)
+        return
+
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name.startswith(".") or entry.name in SKIP_DIRS:
+                    continue
+                _scan(entry.path, files, errors)
+            elif entry.is_file() and entry.name.endswith((".py", ".pyi")):
+                files.append((entry.stat().st_size, entry.path))
+
+
+def split_paths(paths, count) -> list:
+    """Deal paths out into count lists, splitting any list too long for a single command line."""
+    batches = []
+    for i in range(min(count, len(paths))):
+        batch, length = [], 0
+        for path in paths[i::count]:
+            if batch and length + len(path) >= MAX_PATHS_LENGTH:
+                batches.append(batch)
+                batch, length = [], 0
+            batch.append(path)
+            length += len(path) + 1
+        batches.append(batch)
+    return batches
+
+
+def build_cmd(cmd, paths, **kwargs) -> list:
+    """Helper to fill in a command template's arguments, putting the paths in place of {paths}."""
+    argv = []
+    for arg in cmd:
+        if arg == "{paths}":
+            argv += paths
+        elif arg.startswith("{extra_"):
+            # Extra args come as one command line string holding any number of arguments.
+            argv += shlex.split(arg.format(**kwargs))
+        else:
+            argv.append(arg.format(**kwargs))
+    return argv
+
+
+def start_formatter(cmd) -> subprocess.Popen:
+    """Helper to start a formatter process without waiting for it."""
+    return subprocess.Popen(cmd, stdout=PIPE, stderr=STDOUT, bufsize=1, universal_newlines=True)
+
+
+def print_result(cmd, procs, errors=()) -> int:
+    """Helper to print a formatter's prettified output as its processes produce it.
+
+    errors are problems found before the formatter ran, printed first and failing the result.
+    """
+    error_lines = [f"ERROR: {error}" for error in errors]
+    print_output(
+        cmd[0], itertools.chain(error_lines, (line for proc in procs for line in proc.stdout))
+    )
+    for proc in procs:
+        proc.wait()
+
+    return max(proc.returncode for proc in procs) or int(bool(errors))
+
+
+def print_output(name, lines):
+    """Helper to print a formatter's output lines with its name in front, as they come."""
+    prefix = f"{name}: "
+    sep = " " * len(prefix)
+    changes = False
+    for line in lines:
+        if line.strip():
+            print(f"{sep if changes else prefix}{line.rstrip()}")
+            changes = True
+
+    if not changes:
         print(f"{prefix}No changes.")
-    else:
-        print(f"{prefix}{sep.join(lines)}")
 
-    return result.returncode
+
+def format_output(name, lines) -> str:
+    """Helper to put a formatter's name in front of its output lines, all at once."""
+    prefix = f"{name}: "
+    lines = [line.rstrip() for line in lines if line.strip()] or ["No changes."]
+    return prefix + ("\n" + " " * len(prefix)).join(lines)
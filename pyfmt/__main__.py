@@ -31,10 +31,21 @@ def main():
     )
     parser.add_argument("--extra-isort-args", default="", help="additional args to pass to isort")
     parser.add_argument("--extra-black-args", default="", help="additional args to pass to black")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="run in a background process that keeps isort and black loaded between runs,"
+        " starting it if needed",
+    )
 
     opts = parser.parse_args()
 
-    exitcode = pyfmt.pyfmt(
+    run = pyfmt.pyfmt
+    if opts.daemon:
+        from pyfmt import daemon
+
+        run = daemon.run
+    exitcode = run(
         opts.path,
         check=opts.check,
         line_length=opts.line_length,
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+
+CACHE_DIR = os.path.expanduser("~/.cache/pyfmt")
+
+# Files isort and black read their settings from, in the formatted directory or any above it.
+CONFIG_FILES = [".editorconfig", "pyproject.toml", ".isort.cfg", "setup.cfg", "tox.ini"]
+# User-wide settings files isort falls back on.
+USER_CONFIG_FILES = ["~/.editorconfig", "~/.isort.cfg", "~/.config/isort.cfg"]
+
+
+def cache_file(key) -> str:
+    """Path of the cache file for the given formatter settings."""
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+
+def config_digest(path) -> str:
+    """SHA1 over the settings files isort and black could pick up for path, to key the cache by."""
+    directory = os.path.abspath(path)
+    if not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+
+    config_paths = [os.path.expanduser(config_path) for config_path in USER_CONFIG_FILES]
+    while True:
+        config_paths += [os.path.join(directory, name) for name in CONFIG_FILES]
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+
+    digest = hashlib.sha1()
+    for config_path in config_paths:
+        try:
+            with open(config_path, "rb") as handle:
+                digest.update(config_path.encode() + b"\0" + handle.read() + b"\0")
+        except OSError:
+            continue
+    return digest.hexdigest()
+
+
+def load_cache(key) -> dict:
+    """Load the {path: [mtime_ns, size, sha1]} entries of files already formatted with key."""
+    try:
+        with open(cache_file(key)) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(key, cache):
+    """Save the cache entries for key, replacing the cache file in one go.
+
+    The cache only saves time, so nothing is saved if it can't be written, e.g. in a read-only home.
+    """
+    path = cache_file(key)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(path + ".tmp", "w") as handle:
+            json.dump(cache, handle)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+
+def filter_unchanged(files, cache) -> list:
+    """Return the files which changed since they were recorded in the cache."""
+    changed = []
+    for path, abspath in zip(files, absolute_paths(files)):
+        entry = cache.get(abspath)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            changed.append(path)
+            continue
+
+        if entry and entry[:2] == [stat.st_mtime_ns, stat.st_size]:
+            continue
+        # Only touched, e.g. by a checkout, so only now is it worth reading the file.
+        if entry and entry[1] == stat.st_size and entry[2] == file_sha1(path):
+            entry[0] = stat.st_mtime_ns
+            continue
+        changed.append(path)
+    return changed
+
+
+def record(files, cache):
+    """Record the current state of the given, now formatted, files in the cache."""
+    for path, abspath in zip(files, absolute_paths(files)):
+        stat = os.stat(path)
+        cache[abspath] = [stat.st_mtime_ns, stat.st_size, file_sha1(path)]
+
+
+def absolute_paths(paths) -> list:
+    """Like os.path.abspath for each path, but looking up the working directory only once."""
+    cwd = os.getcwd() + os.sep
+    return [os.path.normpath(path if os.path.isabs(path) else cwd + path) for path in paths]
+
+
+def file_sha1(path) -> str:
+    """SHA1 hex digest of a file's contents."""
+    with open(path, "rb") as handle:
+        return hashlib.sha1(handle.read()).hexdigest()
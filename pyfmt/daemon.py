@@ -0,0 +1,137 @@
+import contextlib
+import hashlib
+import io
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import time
+import traceback
+from subprocess import DEVNULL
+
+import pyfmt
+
+
+def socket_path() -> str:
+    """The socket of the daemon for this Python, pyfmt, isort and black.
+
+    Each environment gets its own daemon, so one never formats with another's tool versions, and
+    upgrading any of them starts a new daemon.
+    """
+    versions = [
+        sys.executable,
+        pyfmt.__file__,
+        str(os.stat(pyfmt.__file__).st_mtime_ns),
+        getattr(pyfmt.isort, "__version__", ""),
+        getattr(pyfmt.black, "__version__", ""),
+    ]
+    digest = hashlib.sha1("\0".join(versions).encode()).hexdigest()[:16]
+    return os.path.expanduser(f"~/.cache/pyfmt-{digest}.sock")
+
+
+SOCKET_PATH = socket_path()
+
+# How long the daemon waits for another request before exiting, in seconds.
+IDLE_TIMEOUT = 60 * 60
+
+
+# socketserver only has Unix socket servers where there are Unix sockets, i.e. not on Windows.
+if hasattr(socket, "AF_UNIX"):
+
+    class Server(socketserver.UnixStreamServer):
+        """Unix socket server that stops taking requests once it has been idle for IDLE_TIMEOUT."""
+
+        timeout = IDLE_TIMEOUT
+        idle = False
+
+        def handle_timeout(self):
+            self.idle = True
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Run pyfmt for one client and send back its output and exit code."""
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            try:
+                os.chdir(request.pop("cwd"))
+                exitcode = pyfmt.pyfmt(**request)
+            except Exception:
+                traceback.print_exc(file=output)
+                exitcode = 1
+
+        response = {"exitcode": exitcode, "output": output.getvalue()}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+def serve():
+    """Keep isort and black loaded and run pyfmt for clients of SOCKET_PATH until idle."""
+    import fcntl
+
+    os.makedirs(os.path.dirname(SOCKET_PATH), exist_ok=True)
+    with open(SOCKET_PATH + ".lock", "w") as lock:
+        # The daemon holding the lock owns the socket. Clients starting at the same time may each
+        # start a daemon, and all but the first leave the socket alone and exit.
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        # Left behind by a daemon that didn't exit cleanly.
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(SOCKET_PATH)
+
+        with Server(SOCKET_PATH, RequestHandler) as server:
+            while not server.idle:
+                server.handle_request()
+
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(SOCKET_PATH)
+
+
+def run(path, **kwargs) -> int:
+    """Run pyfmt in the daemon, starting the daemon first if it isn't running yet."""
+    if not hasattr(socket, "AF_UNIX"):
+        return pyfmt.pyfmt(path, **kwargs)
+
+    for attempt in range(51):
+        try:
+            return request(path, **kwargs)
+        except (FileNotFoundError, ConnectionRefusedError):  # Not running (yet).
+            pass
+        except (OSError, ValueError):  # It went away in the middle of the request.
+            break
+
+        if attempt == 0:
+            subprocess.Popen(
+                [sys.executable, "-m", "pyfmt.daemon"],
+                stdin=DEVNULL,
+                stdout=DEVNULL,
+                stderr=DEVNULL,
+                start_new_session=True,
+            )
+        time.sleep(0.1)
+
+    # The daemon isn't there to do it, so don't keep the user waiting on it.
+    return pyfmt.pyfmt(path, **kwargs)
+
+
+def request(path, **kwargs) -> int:
+    """Have the running daemon run pyfmt, then print its output and return its exit code."""
+    message = {"cwd": os.getcwd(), "path": path, **kwargs}
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(SOCKET_PATH)
+        sock.sendall(json.dumps(message).encode() + b"\n")
+        with sock.makefile() as reader:
+            response = json.loads(reader.readline())
+
+    print(response["output"], end="")
+    return response["exitcode"]
+
+
+if __name__ == "__main__":
+    serve()